@@ -133,4 +133,4 @@ for path in paths:
         edge = tuple(sorted(path[i-1:i+1]))
         edge_set.add(edge)
 
-np.save(folder_1hop + '/prefixes.npy', [path[:-2] for path in paths])
+save_prefixes(folder_1hop + '/prefixes.npz', [path[:-2] for path in paths])
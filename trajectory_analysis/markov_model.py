@@ -18,16 +18,11 @@ class Markov_Model():
         """
         Returns all valid n-hop paths in graph G
         """
-        if n == 0:
-            return [[node] for node in G.nodes]
-        else:
-            sub_paths = self.n_hop_paths(G, n - 1)
-            res = []
-            for node in G.nodes:
-                for c in sub_paths:
-                    if G.has_edge(c[-1], node):
-                        res.append(c + [node])
-            return res
+        # grow all paths one hop at a time, only through the neighbors of each path's last node
+        paths = [[node] for node in G.nodes]
+        for _ in range(n):
+            paths = [path + [nbr] for path in paths for nbr in G[path[-1]]]
+        return paths
 
     def neighborhood(self, G, v):
         """
@@ -26,6 +26,8 @@ trajectory_data_1hop/
         -neighbors are ordered by increasing node number
     -test_mask.npy: vector of length n_trajectories; 1 if this trajectory is in the test set, else 0
     -train_mask.npy: same, for training set
+    -prefixes.npz (optional): the node sequence of each trajectory prefix, stored as flat arrays (nodes, indptr);
+        save with save_prefixes(), load with load_prefixes()
 trajectory_data_2hop/
     -Pretty much the same, but for predicting the second "hop" after the known prefix. My code doesn't actually do any
     multi-hop predictions atm, so you can just copy-paste your 1hop data to the 2-hop folder, and it should work fine.
@@ -37,8 +39,12 @@ trajectory_data_2hop/
 import numpy as np
 import networkx as nx
 from scipy.spatial import Delaunay
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import breadth_first_order
 import os
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
+from matplotlib.collections import PolyCollection
 
 def strip_paths(paths):
     """
@@ -64,8 +70,9 @@ def color_faces(G, V, coords, faces, filename='graph_faces.pdf', paths=None):
     """
     Saves a plot of the graph, with faces colored in
     """
-    for f in np.array(faces):
-        plt.gca().add_patch(plt.Polygon(coords[f], facecolor=(173/256,216/256,240/256, 0.4), ec='k', linewidth=0.3))
+    # all faces in a single collection, rather than one patch per face
+    face_coords = coords[np.array(faces, dtype=np.int64).reshape(-1, 3)]
+    plt.gca().add_collection(PolyCollection(face_coords, facecolor=(173/256,216/256,240/256, 0.4), ec='k', linewidth=0.3))
 
     nx.draw_networkx(G, with_labels=False,
                       width=0.3,
@@ -111,23 +118,18 @@ def random_SC_graph(n, holes=True):
 
     if not holes:
         valid_idxs = np.array(range(len(coords)))
-    faces = np.array(sorted([sorted(t) for t in tri.simplices if np.in1d(t, valid_idxs).all()]))
+    valid_mask = np.zeros(n, dtype=bool)
+    valid_mask[valid_idxs] = True
+    faces = np.sort(tri.simplices[valid_mask[tri.simplices].all(axis=1)], axis=1)
+    faces = np.unique(faces, axis=0) # sorted faces, in sorted order
 
     # SC matrix construction
     G = nx.OrderedDiGraph()
     G.add_nodes_from(np.arange(n)) # add nodes that are excluded to keep indexing easy
-    E = []
-    for f in faces:
-        [a,b,c] = sorted(f)
-        E.append((a,b))
-        E.append((b,c))
-        E.append((a,c))
+    E = np.unique(np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [0, 2]]]), axis=0)
 
     V = np.array(G.nodes)
-    E = np.array(sorted(set(E)))
-
-    for e in E:
-        G.add_edge(*e)
+    G.add_edges_from(E.tolist())
 
 
     edge_to_idx = {tuple(E[i]): i for i in range(len(E))}
@@ -149,33 +151,88 @@ def incidence_matrices(G, V, E, faces, edge_to_idx):
     B1[i][j]: -1 if node is is tail of edge j, 1 if node is head of edge j, else 0 (tail -> head) (smaller -> larger)
     B2[i][j]: 1 if edge i appears sorted in face j, -1 if edge i appears reversed in face j, else 0; given faces with sorted node order
     """
-    B1 = np.array(nx.incidence_matrix(G, nodelist=V, edgelist=E, oriented=True).todense())
-    B2 = np.zeros([len(E),len(faces)])
-
-    for f_idx, face in enumerate(faces): # face is sorted
-        edges = [face[:-1], face[1:], [face[0], face[2]]]
-        e_idxs = [edge_to_idx[tuple(e)] for e in edges]
-
-        B2[e_idxs[:-1], f_idx] = 1
-        B2[e_idxs[-1], f_idx] = -1
+    # edge j runs from tail E[j][0] (-1) to head E[j][1] (+1); self-loops get an empty column
+    V_arr, E_arr = np.asarray(V), np.asarray(E).reshape(-1, 2)
+    if np.all(V_arr[:-1] < V_arr[1:]):
+        # V is sorted (np.arange(n), or sorted(G.nodes)), so each endpoint's row is found by binary search
+        tails, heads = np.searchsorted(V_arr, E_arr[:, 0]), np.searchsorted(V_arr, E_arr[:, 1])
+    else:
+        node_to_idx = {v: i for i, v in enumerate(V)}
+        tails = np.fromiter((node_to_idx[e[0]] for e in E), dtype=np.int64, count=len(E))
+        heads = np.fromiter((node_to_idx[e[1]] for e in E), dtype=np.int64, count=len(E))
+    e_idxs = np.nonzero(tails != heads)[0]
+
+    B1 = np.zeros([len(V), len(E)], dtype=np.float32)
+    B1[tails[e_idxs], e_idxs] = -1
+    B1[heads[e_idxs], e_idxs] = 1
+
+    B2 = np.zeros([len(E),len(faces)], dtype=np.float32)
+    if len(faces) == 0:
+        return B1, B2
+
+    # look up all face edges in one pass
+    edge_table = edge_key_table(edge_to_idx)
+    faces = np.asarray(faces, dtype=np.int64) # faces are sorted
+    f_idxs = np.arange(len(faces))
+    B2[lookup_edges(edge_table, faces[:, 0], faces[:, 1]), f_idxs] = 1  # (a, b)
+    B2[lookup_edges(edge_table, faces[:, 1], faces[:, 2]), f_idxs] = 1  # (b, c)
+    B2[lookup_edges(edge_table, faces[:, 0], faces[:, 2]), f_idxs] = -1 # (a, c)
     return B1, B2
 
 def faces_from_B2(B2, E):
     """
     Given a B2 matrix, returns the list of faces.
+    Each column of B2 must have exactly 3 nonzero entries, one per edge of its triangle.
     """
-    faces_B2 = []
-    for j in range(B2.shape[1]):
-        edge_idxs = np.where(B2[:, j] != 0)
-        edges = E[edge_idxs]
-        nodes = set()
-        for e in edges:
-            for n in e:
-                nodes.add(n)
-        faces_B2.append(tuple(sorted(nodes)))
-    return faces_B2
+    if np.any(np.count_nonzero(B2, axis=0) != 3):
+        raise ValueError('each column of B2 must have exactly 3 nonzero entries, one per edge of a triangle')
+    # each face has 3 edges, which together list each of its nodes twice
+    _, edge_idxs = np.nonzero(B2.T)
+    face_nodes = np.sort(np.asarray(E)[edge_idxs].reshape(B2.shape[1], 6), axis=1)[:, ::2]
+    return [tuple(f) for f in face_nodes.tolist()]
+
+def bfs_predecessors(adj_matrix, source):
+    """
+    Returns each node's predecessor in the BFS tree rooted at source, as an int32 array (negative if unreachable)
+    """
+    return breadth_first_order(adj_matrix, source, return_predecessors=True)[1].astype(np.int32, copy=False)
 
-def generate_random_walks(G, points, valid_idxs, m=1000):
+def extend_to_root(path, preds, root):
+    """
+    Follows BFS predecessors from the last node of path up to root, appending each node onto path in place
+    """
+    node = path[-1]
+    if node != root and preds[node] < 0:
+        raise nx.NetworkXNoPath('No path between {} and {}'.format(node, root))
+    while node != root:
+        node = int(preds[node])
+        path.append(node)
+
+def bfs_path(adj_matrix, source, target):
+    """
+    Returns the shortest path from source to target, following the BFS tree rooted at target
+    """
+    path = [int(source)]
+    extend_to_root(path, bfs_predecessors(adj_matrix, target), target)
+    return path
+
+# adjacency matrix used by bfs_path_worker(); set once per worker process by init_bfs_worker()
+worker_adj_matrix = None
+
+def init_bfs_worker(adj_matrix):
+    """
+    Process pool initializer; stores the adjacency matrix once per worker, instead of pickling it with every task
+    """
+    global worker_adj_matrix
+    worker_adj_matrix = adj_matrix
+
+def bfs_path_worker(endpoints):
+    """
+    bfs_path() on the worker's adjacency matrix, for endpoints (source, target)
+    """
+    return bfs_path(worker_adj_matrix, *endpoints)
+
+def generate_random_walks(G, points, valid_idxs, m=1000, G_undir=None, n_jobs=1):
     """
     Generates m random walks over the valid nodes in G.
 
@@ -190,6 +247,8 @@ def generate_random_walks(G, points, valid_idxs, m=1000):
     :param E: sorted list of edges in E
     :param edge_to_idx: map (edge tuple -> index
     :param m: # of walks to generate
+    :param G_undir: undirected version of G, if already computed
+    :param n_jobs: # of processes to compute the walks' middle legs with
 
     Returns:
         paths: List of walks (each walk is a list of nodes)
@@ -218,42 +277,97 @@ def generate_random_walks(G, points, valid_idxs, m=1000):
     B2_ = B012[points[B012, 1] - points[B012, 0] < -1 / 2]
 
     paths = []
-    G_undir = G.to_undirected()
-    i = 0
-    while len(paths) < m:
-        v_begin = np.random.choice(BEGIN)
-        if i % 3 == 0:
-            v_1 = np.random.choice(A0)
-            v_2 = np.random.choice(B0)
-        elif i % 3 == 1:
-            v_1 = np.random.choice(A1)
-            v_2 = np.random.choice(B1_)
-        else:
-            v_1 = np.random.choice(A2)
-            v_2 = np.random.choice(B2_)
-        v_end = np.random.choice(END)
+    if G_undir is None:
+        G_undir = G.to_undirected()
+
+    # BFS trees rooted at BEGIN and END nodes, computed once each: those regions are small, so their nodes repeat
+    #   often. Middle legs run between A012 and B012 nodes, which cover most of the graph, so their trees aren't kept;
+    #   one tree per node would take O(n^2) memory
+    indptr, indices = adjacency_csr(G_undir)
+    adj_matrix = csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(indptr) - 1, len(indptr) - 1))
+    predecessors = {}
+
+    def cached_bfs_tree(root):
+        if root not in predecessors:
+            predecessors[root] = bfs_predecessors(adj_matrix, root)
+        return predecessors[root]
+
+    # middle legs are independent, so with n_jobs > 1 they're split across one process pool for the whole run
+    pool = None
+    if n_jobs > 1:
+        pool = ProcessPoolExecutor(max_workers=n_jobs, initializer=init_bfs_worker, initargs=(adj_matrix,))
 
-        path = nx.shortest_path(G_undir, v_begin, v_1)[:-1] + \
-               nx.shortest_path(G_undir, v_1, v_2)[:-1] + \
-               nx.shortest_path(G_undir, v_2, v_end)
-        if len(path) == len(set(path)):
-            paths.append(path)
-            i += 1
+    try:
+        while len(paths) < m:
+            # draw endpoints for all remaining walks at once; walk i goes through regions A(i % 3) and B(i % 3)
+            n_draws = m - len(paths)
+            v_begins = np.random.choice(BEGIN, size=n_draws)
+            v_1s = [np.random.choice(A, size=n_draws) for A in (A0, A1, A2)]
+            v_2s = [np.random.choice(B, size=n_draws) for B in (B0, B1_, B2_)]
+            v_ends = np.random.choice(END, size=n_draws)
+
+            middle_legs = {}
+            if pool is not None:
+                # the middle leg of each draw's region, assuming no walks get rejected; any others are computed below
+                regions = (len(paths) + np.arange(n_draws)) % 3
+                draw_idxs = np.arange(n_draws)
+                endpoints = list(zip(np.stack(v_1s)[regions, draw_idxs].tolist(),
+                                     np.stack(v_2s)[regions, draw_idxs].tolist()))
+                middle_legs = dict(zip(endpoints, pool.map(bfs_path_worker, endpoints,
+                                                           chunksize=max(1, n_draws // (4 * n_jobs)))))
+
+            for j in range(n_draws):
+                region = len(paths) % 3
+                v_begin, v_1, v_2, v_end = v_begins[j], v_1s[region][j], v_2s[region][j], v_ends[j]
+
+                # the BEGIN leg is backtracked from v_1 and reversed; the other legs are followed forward to their roots
+                path = [int(v_1)]
+                extend_to_root(path, cached_bfs_tree(v_begin), v_begin)
+                path.reverse()
+                middle_leg = middle_legs.get((v_1, v_2))
+                if middle_leg is None:
+                    middle_leg = bfs_path(adj_matrix, v_1, v_2)
+                path.extend(middle_leg[1:])
+                extend_to_root(path, cached_bfs_tree(v_end), v_end)
+                if len(path) == len(set(path)):
+                    paths.append(path)
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
     return G_undir, paths
 
+def flatten_paths(paths):
+    """
+    Flattens a list of variable-length paths into arrays (indptr, nodes); path i is nodes[indptr[i]:indptr[i+1]]
+    """
+    indptr = np.zeros(len(paths) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(p) for p in paths])
+    nodes = np.concatenate([np.asarray(p, dtype=np.int64) for p in paths]) if len(paths) else np.zeros(0, dtype=np.int64)
+    return indptr, nodes
+
+def split_path_bounds(indptr, truncate_paths=True, suffix_size=2):
+    """
+    Truncates paths flattened with flatten_paths() (if indicated), then splits each into prefix + suffix
+
+    Returns the start of each path, and the end (exclusive) of each path's prefix; the suffix follows the prefix
+    """
+    starts = indptr[:-1]
+    lens = np.diff(indptr)
+    if truncate_paths:
+        lens = 4 + np.random.randint(2, lens - 4)
+    return starts, starts + lens - suffix_size
+
 def split_paths(paths, truncate_paths=True, suffix_size=2):
     """
     Truncates paths (if indicated), then splits each into prefix + suffix
     """
-    if truncate_paths:
-        paths_truncated = [p[:4 + np.random.choice(range(2, len(p) - 4))] for p in paths]
-    else:
-        paths_truncated = paths
+    indptr, nodes = flatten_paths(paths)
+    starts, prefix_ends = split_path_bounds(indptr, truncate_paths=truncate_paths, suffix_size=suffix_size)
 
-    prefixes = [p[:-suffix_size] for p in paths_truncated]
-    suffixes = [p[-suffix_size:] for p in paths_truncated]
-    last_nodes = [p[-1] for p in prefixes]
+    prefixes = [nodes[start:end].tolist() for start, end in zip(starts, prefix_ends)]
+    suffixes = nodes[prefix_ends[:, None] + np.arange(suffix_size)].tolist()
+    last_nodes = nodes[prefix_ends - 1].tolist()
 
     return prefixes, suffixes, last_nodes
 
@@ -263,21 +377,41 @@ def conditional_incidence_matrix(B1, Nv, D):
     Nv: row indices of B1 to extract
     D: max degree, for zero padding
     '''
-    B_cond = np.zeros([D,B1.shape[1]])
+    B_cond = np.zeros([D,B1.shape[1]], dtype=np.float32)
     B_cond[:len(Nv),:] = B1[Nv]
     return B_cond
 
 def generate_Bconds(G_undir, B1, last_nodes, max_degree):
     """
     Generates the conditional incidence matrix for each "last node" in a path, padded to the size of the max degree
+
+    Returns an array of shape (len(last_nodes), max_degree, |E|)
     """
-    B_conds = []
-    for n in last_nodes:
-        n_nbrs = np.array(sorted(G_undir[n]))
-        B_cond = conditional_incidence_matrix(B1, n_nbrs, max_degree)
-        B_conds.append(B_cond)
+    indptr, indices = adjacency_csr(G_undir)
+    last_nodes = np.asarray(last_nodes, dtype=np.int64)
+    n_nbrs = indptr[last_nodes + 1] - indptr[last_nodes]
+
+    # (path, neighbor slot) pairs that hold a real neighbor; the remaining slots stay zero-padded
+    path_idxs, slots = np.nonzero(np.arange(max_degree) < n_nbrs[:, None])
+    B_conds = np.zeros([len(last_nodes), max_degree, B1.shape[1]], dtype=B1.dtype)
+    B_conds[path_idxs, slots] = B1[indices[indptr[last_nodes[path_idxs]] + slots]]
     return B_conds
 
+def adjacency_csr(G):
+    """
+    Returns the adjacency of undirected graph G (with nodes 0, ..., n-1) in CSR form, as arrays (indptr, indices);
+        the neighbors of node v are indices[indptr[v]:indptr[v+1]], in increasing order
+    """
+    n = int(max(G.nodes)) + 1 if len(G) else 0
+    edges = np.array(G.edges, dtype=np.int64).reshape(-1, 2)
+
+    # key each directed (row, col) pair as row * n + col; np.unique sorts by row, then by col
+    keys = np.unique(np.concatenate([edges[:, 0] * n + edges[:, 1], edges[:, 1] * n + edges[:, 0]]))
+    indptr = np.zeros(n + 1, dtype=np.int32)
+    indptr[1:] = np.cumsum(np.bincount(keys // n, minlength=n))
+    indices = (keys % n).astype(np.int32)
+    return indptr, indices
+
 def neighborhood(G, v):
     '''
     G: networkx undirected graph
@@ -291,11 +425,35 @@ def neighborhood_to_onehot(Nv, w, D):
     w: integer, presumably present in Nv
     D: max degree, for zero padding
     '''
-    onehot = (Nv==w).astype(np.float)
-    onehot_final = np.zeros(D)
+    onehot = (Nv==w).astype(np.float32)
+    onehot_final = np.zeros(D, dtype=np.float32)
     onehot_final[:onehot.shape[0]] = onehot
     return np.array([onehot_final]).T
 
+def neighborhoods_to_onehot(adj, last_nodes, next_nodes, D):
+    '''
+    adj: CSR adjacency (indptr, indices) from adjacency_csr()
+    last_nodes: list of nodes
+    next_nodes: list of nodes, each presumably a neighbor of the matching last node
+    D: max degree, for zero padding
+
+    Returns an array of shape (len(last_nodes), D, 1); same as stacking neighborhood_to_onehot() for each pair
+    '''
+    indptr, indices = adj
+    n = len(indptr) - 1
+    last_nodes = np.asarray(last_nodes, dtype=np.int64)
+    next_nodes = np.asarray(next_nodes, dtype=np.int64)
+
+    # (node, neighbor) keys of all CSR entries are sorted, so one binary search finds every neighbor's position
+    entry_keys = np.repeat(np.arange(n, dtype=np.int64), np.diff(indptr)) * n + indices
+    query_keys = last_nodes * n + next_nodes
+    pos = np.minimum(np.searchsorted(entry_keys, query_keys), len(entry_keys) - 1)
+    found = np.nonzero(entry_keys[pos] == query_keys)[0]
+
+    onehot = np.zeros([len(last_nodes), D, 1], dtype=np.float32)
+    onehot[found, pos[found] - indptr[last_nodes[found]], 0] = 1
+    return onehot
+
 def flow_to_path(flow, E, last_node):
     """
     Given a flow vector and the last node in the path, returns the path
@@ -324,55 +482,141 @@ def flow_to_path(flow, E, last_node):
     path[0] = int(path[0])
     return path[::-1]
 
+def edge_key_table(edge_to_idx):
+    """
+    Packs each edge (a, b) into an integer key a * N + b, for vectorized edge lookups with lookup_edges(); hashing
+        one int64 is much cheaper than hashing an edge tuple, and a sorted key array needs no dict at all
+
+    Returns the sorted keys, the index of the edge with each key, and N
+    """
+    edges = np.array(list(edge_to_idx.keys()), dtype=np.int64).reshape(-1, 2)
+    idxs = np.array(list(edge_to_idx.values()), dtype=np.int64)
+    N = int(edges.max()) + 1 if len(edges) else 1
+
+    keys = edges[:, 0] * N + edges[:, 1]
+    order = np.argsort(keys)
+    return keys[order], idxs[order], N
+
+def lookup_edges(edge_table, tails, heads):
+    """
+    Vectorized version of edge_to_idx[(tails[i], heads[i])], using a table from edge_key_table()
+    """
+    keys, idxs, N = edge_table
+    tails, heads = np.asarray(tails, dtype=np.int64), np.asarray(heads, dtype=np.int64)
+    if len(tails) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    query_keys = tails * N + heads
+    pos = np.minimum(np.searchsorted(keys, query_keys), max(len(keys) - 1, 0))
+    if len(keys) == 0 or np.any(heads >= N) or not np.array_equal(keys[pos], query_keys):
+        raise KeyError('edge not in edge_to_idx')
+    return idxs[pos]
+
+def segments_to_flows(nodes, starts, ends, edge_to_idx, m, edge_table=None):
+    '''
+    nodes: array of nodes holding all paths, e.g. from flatten_paths()
+    starts, ends: path i is nodes[starts[i]:ends[i]]
+    edge_to_idx: dictionary mapping edge tuples to indices
+    m: number of edges
+    edge_table: edge_key_table(edge_to_idx), if already built; pass it when calling this repeatedly
+
+    Returns an array of shape (len(starts), m, 1) holding the flow of each path
+    '''
+    n_paths = len(starts)
+    flows = np.zeros([n_paths, m, 1], dtype=np.float32)
+    if n_paths == 0:
+        return flows
+
+    # every step of every path, flattened: step k goes from nodes[k] to nodes[k + 1]
+    n_steps = np.maximum(np.asarray(ends) - np.asarray(starts) - 1, 0)
+    path_idxs = np.repeat(np.arange(n_paths), n_steps)
+    step_offsets = np.arange(n_steps.sum()) - np.repeat(np.cumsum(n_steps) - n_steps, n_steps)
+    k = np.repeat(starts, n_steps) + step_offsets
+    v0, v1 = nodes[k], nodes[k + 1]
+
+    if edge_table is None:
+        edge_table = edge_key_table(edge_to_idx)
+    e_idxs = lookup_edges(edge_table, np.minimum(v0, v1), np.maximum(v0, v1))
+
+    np.add.at(flows, (path_idxs, e_idxs, 0), np.where(v0 < v1, 1, -1))
+    return flows
+
+def paths_to_flows(paths, edge_to_idx, m):
+    '''
+    paths: list of paths, each a list of nodes
+    edge_to_idx: dictionary mapping edge tuples to indices
+    m: number of edges
+
+    Returns an array of shape (len(paths), m, 1) holding the flow of each path
+    '''
+    indptr, nodes = flatten_paths(paths)
+    return segments_to_flows(nodes, indptr[:-1], indptr[1:], edge_to_idx, m)
+
 def path_to_flow(path, edge_to_idx, m):
     '''
     path: list of nodes
-    E_lookup: dictionary mapping edge tuples to indices
+    edge_to_idx: dictionary mapping edge tuples to indices
     m: number of edges
     '''
-    l = len(path)
-    f = np.zeros([m,1])
-    for j in range(l-1):
-        v0 = path[j]
-        v1 = path[j+1]
-        if v0 < v1:
-            k = edge_to_idx[(v0,v1)]
-            f[k] += 1
-        else:
-            k = edge_to_idx[(v1,v0)]
-            f[k] -= 1
-    return f
+    return paths_to_flows([path], edge_to_idx, m)[0]
 
-def path_dataset(G_undir, E, edge_to_idx, paths, max_degree, include_2hop=True, truncate_paths=True):
+def save_flows(filename, nodes, starts, ends, edge_to_idx, m, chunk_size=1024, edge_table=None):
+    """
+    Writes the flows of paths nodes[starts[i]:ends[i]] to a .npy file (same format as np.save), chunk_size paths at a
+        time; only one chunk of dense flows is held in memory at once
+
+    Returns the flows as a read-only memory-mapped array
+    """
+    if edge_table is None:
+        edge_table = edge_key_table(edge_to_idx)
+    flows = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=(len(starts), m, 1))
+    for i in range(0, len(starts), chunk_size):
+        flows[i:i + chunk_size] = segments_to_flows(nodes, starts[i:i + chunk_size], ends[i:i + chunk_size],
+                                                    edge_to_idx, m, edge_table=edge_table)
+    flows.flush()
+    del flows
+    return np.load(filename, mmap_mode='r')
+
+def path_dataset(G_undir, E, edge_to_idx, paths, max_degree, include_2hop=True, truncate_paths=True, flow_files=None,
+                 chunk_size=1024):
     """
     Builds necessary matrices for 1-hop and 2-hop learning, from a list of paths
+
+    If flow_files (1-hop filename, 2-hop filename) is given, the flows are streamed to those .npy files in chunks of
+        chunk_size paths with save_flows(), and returned memory-mapped instead of being held in memory
     """
-    # 1-hop
-    prefixes_1hop, suffixes, last_nodes = split_paths(paths, truncate_paths=truncate_paths,
-                                                      suffix_size=(2 if include_2hop else 1))
-    suffixes_1hop = [s[0] for s in suffixes]
-    prefix_flows = np.array([path_to_flow(p, edge_to_idx, len(E)) for p in prefixes_1hop])
+    edge_table = edge_key_table(edge_to_idx)
+
+    def build_flows(ends, hop):
+        if flow_files is None:
+            return segments_to_flows(nodes, starts, ends, edge_to_idx, len(E), edge_table=edge_table)
+        return save_flows(flow_files[hop - 1], nodes, starts, ends, edge_to_idx, len(E), chunk_size=chunk_size,
+                          edge_table=edge_table)
+
+    # 1-hop; prefixes are kept as (start, end) bounds into the flattened paths
+    indptr, nodes = flatten_paths(paths)
+    starts, prefix_ends = split_path_bounds(indptr, truncate_paths=truncate_paths,
+                                            suffix_size=(2 if include_2hop else 1))
+    last_nodes = nodes[prefix_ends - 1]
+    suffixes_1hop = nodes[prefix_ends]
+    prefix_flows = build_flows(prefix_ends, 1)
 
-    targets = np.array(
-        [neighborhood_to_onehot(neighborhood(G_undir, prefix[-1]), suffix, max_degree) for prefix, suffix in
-         zip(prefixes_1hop, suffixes_1hop)])
+    adj = adjacency_csr(G_undir)
+    targets = neighborhoods_to_onehot(adj, last_nodes, suffixes_1hop, max_degree)
 
     if not include_2hop:
         return prefix_flows, targets, last_nodes, suffixes_1hop, [], [], [], []
 
-    # 2-hop
-    prefixes_2hop = [np.concatenate([p, [s]]) for p, s in zip(prefixes_1hop, suffixes_1hop)]
-    suffixes_2hop = [s[1] for s in suffixes]
-    last_nodes_2hop = [s[0] for s in suffixes]
-    prefix_flows_2hop = np.array([path_to_flow(p, edge_to_idx, len(E)) for p in prefixes_2hop])
+    # 2-hop; each prefix is extended by the first suffix node
+    suffixes_2hop = nodes[prefix_ends + 1]
+    last_nodes_2hop = suffixes_1hop
+    prefix_flows_2hop = build_flows(prefix_ends + 1, 2)
 
-    targets_2hop = np.array(
-        [neighborhood_to_onehot(neighborhood(G_undir, prefix[-1]), suffix, max_degree) for prefix, suffix in
-         zip(prefixes_2hop, suffixes_2hop)])
+    targets_2hop = neighborhoods_to_onehot(adj, last_nodes_2hop, suffixes_2hop, max_degree)
 
     return prefix_flows, targets, last_nodes, suffixes_1hop, prefix_flows_2hop, targets_2hop, last_nodes_2hop, suffixes_2hop
 
-def generate_dataset(n, m, folder, holes=True):
+def generate_dataset(n, m, folder, holes=True, n_jobs=1):
     # generate graph
     G, V, E, faces, edge_to_idx, coords, valid_idxs = random_SC_graph(n, holes=holes)
 
@@ -380,11 +624,12 @@ def generate_dataset(n, m, folder, holes=True):
 
     # B1, B2
     B1, B2 = incidence_matrices(G, V, E, faces, edge_to_idx)
-    G_undir, paths = generate_random_walks(G, coords, valid_idxs, m=m)
+    G_undir = G.to_undirected()
+    _, paths = generate_random_walks(G, coords, valid_idxs, m=m, G_undir=G_undir, n_jobs=n_jobs)
     rev_paths = [path[::-1] for path in paths]
 
     # Save image of graph to file
-    color_faces(G.to_undirected(), V, coords, faces, filename='synthetic_graph_faces_paths.pdf',
+    color_faces(G_undir, V, coords, faces, filename='synthetic_graph_faces_paths.pdf',
                 paths=[paths[11], paths[7][:-1], paths[18][:-1]])
 
 
@@ -394,16 +639,27 @@ def generate_dataset(n, m, folder, holes=True):
     test_mask = 1 - train_mask
 
 
-    max_degree = np.max([deg for n, deg in G_undir.degree()])
+    max_degree = max(len(nbrs) for nbrs in G_undir.adj.values())
     print(max_degree)
 
+    folder_1hop = 'trajectory_data_1hop_' + folder
+    folder_2hop = 'trajectory_data_2hop_' + folder
+    try:
+        os.mkdir(folder_1hop), os.mkdir(folder_2hop)
+    except:
+        pass
+
+    # flows are the largest arrays, so path_dataset streams them straight to their files
+    flow_files = (os.path.join(folder_1hop, 'flows_in.npy'), os.path.join(folder_2hop, 'flows_in.npy'))
+    rev_flow_files = (os.path.join(folder_1hop, 'rev_flows_in.npy'), os.path.join(folder_2hop, 'rev_flows_in.npy'))
+
     # forward
     prefix_flows_1hop, targets_1hop, last_nodes_1hop, suffixes_1hop, \
-        prefix_flows_2hop, targets_2hop, last_nodes_2hop, suffixes_2hop = path_dataset(G_undir, E, edge_to_idx, paths, max_degree)
+        prefix_flows_2hop, targets_2hop, last_nodes_2hop, suffixes_2hop = path_dataset(G_undir, E, edge_to_idx, paths, max_degree, flow_files=flow_files)
 
     # reversed
     rev_prefix_flows_1hop, rev_targets_1hop, rev_last_nodes_1hop, rev_suffixes_1hop, \
-        rev_prefix_flows_2hop, rev_targets_2hop, rev_last_nodes_2hop, rev_suffixes_2hop = path_dataset(G_undir, E, edge_to_idx, rev_paths, max_degree)
+        rev_prefix_flows_2hop, rev_targets_2hop, rev_last_nodes_2hop, rev_suffixes_2hop = path_dataset(G_undir, E, edge_to_idx, rev_paths, max_degree, flow_files=rev_flow_files)
 
     dataset_1hop = [prefix_flows_1hop, B1, B2, targets_1hop, train_mask, test_mask, G_undir, coords, last_nodes_1hop,
                     suffixes_1hop, rev_prefix_flows_1hop, rev_targets_1hop, rev_last_nodes_1hop, rev_suffixes_1hop]
@@ -411,16 +667,11 @@ def generate_dataset(n, m, folder, holes=True):
                     suffixes_2hop, rev_prefix_flows_2hop, rev_targets_2hop, rev_last_nodes_2hop, rev_suffixes_2hop]
 
     # save datasets
-    folder_1hop = 'trajectory_data_1hop_' + folder
-    folder_2hop = 'trajectory_data_2hop_' + folder
-    try:
-        os.mkdir(folder_1hop), os.mkdir(folder_2hop)
-    except:
-        pass
-
     filenames = ('flows_in', 'B1', 'B2', 'targets', 'train_mask', 'test_mask', 'G_undir', 'coords', 'last_nodes', 'target_nodes', 'rev_flows_in', 'rev_targets', 'rev_last_nodes', 'rev_target_nodes')
     for arr_1hop, arr_2hop, filename in zip(dataset_1hop, dataset_2hop, filenames):
-        if filename == 'G_undir':
+        if filename in ('flows_in', 'rev_flows_in'):
+            continue # already written by path_dataset
+        elif filename == 'G_undir':
             nx.readwrite.gpickle.write_gpickle(G_undir, os.path.join(folder_1hop, filename + '.pkl'))
             nx.readwrite.gpickle.write_gpickle(G_undir, os.path.join(folder_2hop, filename + '.pkl'))
         else:
@@ -439,13 +690,36 @@ def load_dataset(folder):
     # print(B_matrices[0][10])
 
     try:
-        prefixes = np.load(folder + '/prefixes.npy')
+        prefixes = load_prefixes(folder + '/prefixes.npz')
     except:
         prefixes = None
 
     return np.load(file_paths[0]), [np.load(p) for p in file_paths[1:3]], np.load(file_paths[3]), \
            np.load(file_paths[4]), np.load(file_paths[5]), G_undir, np.load(file_paths[7]), np.load(file_paths[8])
 
+def save_prefixes(filename, prefixes):
+    """
+    Saves a list of variable-length prefixes as flat typed arrays, so they can be loaded without pickle:
+        nodes: all prefixes concatenated
+        indptr: prefix i is nodes[indptr[i]:indptr[i+1]]
+    """
+    indptr, nodes = flatten_paths(prefixes)
+    np.savez_compressed(filename, nodes=nodes, indptr=indptr)
+
+def load_prefixes(filename):
+    """
+    Loads prefixes saved with save_prefixes(), as a list of lists of nodes
+
+    If there's no such .npz file, falls back to a pickled .npy file of the same name, as saved by older versions
+    """
+    root, ext = os.path.splitext(filename)
+    if ext != '.npz' or not os.path.exists(filename):
+        return [list(p) for p in np.load(root + '.npy', allow_pickle=True)]
+
+    with np.load(filename) as data:
+        nodes, indptr = data['nodes'].tolist(), data['indptr'].tolist()
+    return [nodes[indptr[i]:indptr[i + 1]] for i in range(len(indptr) - 1)]
+
 def to_rnn_format(folder, prefixes_file=None):
     """
     Converts dataset to the format used by this repo https://github.com/wuhao5688/RNN-TrajModel
@@ -463,7 +737,7 @@ def to_rnn_format(folder, prefixes_file=None):
     if not prefixes_file:
         prefixes = [flow_to_path(flow, E, last_node) for flow, last_node in zip(flows, last_nodes)]
     else:
-        prefixes = np.load(folder + '/' + prefixes_file, allow_pickle=True)
+        prefixes = load_prefixes(folder + '/' + prefixes_file)
     paths = [prefix + [target] for prefix, target in zip(prefixes, target_nodes)]
     coords = [[0, 0]] * len(G_undir.nodes)
 
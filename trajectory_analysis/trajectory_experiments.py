@@ -65,12 +65,12 @@ import numpy as onp
 
 try:
     from trajectory_analysis.bunch_model_matrices import compute_shift_matrices
-    from trajectory_analysis.synthetic_data_gen import load_dataset, generate_dataset, neighborhood, conditional_incidence_matrix, flow_to_path
+    from trajectory_analysis.synthetic_data_gen import load_dataset, load_prefixes, generate_dataset, neighborhood, conditional_incidence_matrix, flow_to_path
     from trajectory_analysis.scone_trajectory_model import Scone_GCN
     from trajectory_analysis.markov_model import Markov_Model
 except Exception:
     from bunch_model_matrices import compute_shift_matrices
-    from synthetic_data_gen import load_dataset, generate_dataset, neighborhood, conditional_incidence_matrix, flow_to_path
+    from synthetic_data_gen import load_dataset, load_prefixes, generate_dataset, neighborhood, conditional_incidence_matrix, flow_to_path
     from scone_trajectory_model import Scone_GCN
     from markov_model import Markov_Model
 
@@ -281,7 +281,7 @@ def data_setup(hops=(1,), load=True, folder_suffix='schaub'):
 
     # load prefixes if they exist
     try:
-        prefixes = list(np.load('trajectory_data_1hop_' + folder_suffix + '/prefixes.npy', allow_pickle=True))
+        prefixes = load_prefixes('trajectory_data_1hop_' + folder_suffix + '/prefixes.npz')
     except:
         prefixes = [flow_to_path(inputs_all[0][-1][i], E, last_nodes[i]) for i in range(len(last_nodes))]
 